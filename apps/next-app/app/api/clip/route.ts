@@ -1,4 +1,5 @@
 import { NextRequest, NextResponse } from 'next/server';
+import { LRUCache } from '@/lib/lru-cache';
 
 // Cache the model at module level for reuse across requests
 let modelPromise: Promise<any> | null = null;
@@ -34,44 +35,111 @@ async function getTokenizer() {
   return tokenizerPromise;
 }
 
-export async function POST(request: NextRequest) {
-  try {
-    const { text } = await request.json();
+// Concurrent requests are queued and encoded together in one forward pass
+const MAX_BATCH_SIZE = 32;
+const MAX_BATCH_WAIT_MS = 5;
 
-    if (!text || typeof text !== 'string') {
-      return NextResponse.json(
-        { error: 'Missing or invalid "text" field' },
-        { status: 400 }
-      );
+type PendingEmbedding = {
+  text: string;
+  resolve: (embedding: number[]) => void;
+  reject: (error: unknown) => void;
+};
+
+let pending: PendingEmbedding[] = [];
+let flushTimer: ReturnType<typeof setTimeout> | null = null;
+
+function embedText(text: string): Promise<number[]> {
+  return new Promise((resolve, reject) => {
+    pending.push({ text, resolve, reject });
+    if (pending.length >= MAX_BATCH_SIZE) {
+      void flushPending();
+    } else if (!flushTimer) {
+      flushTimer = setTimeout(flushPending, MAX_BATCH_WAIT_MS);
     }
+  });
+}
+
+async function flushPending() {
+  if (flushTimer) {
+    clearTimeout(flushTimer);
+    flushTimer = null;
+  }
+  const batch = pending.slice(0, MAX_BATCH_SIZE);
+  pending = pending.slice(MAX_BATCH_SIZE);
+  if (pending.length > 0) {
+    flushTimer = setTimeout(flushPending, 0);
+  }
+  if (batch.length === 0) return;
 
+  try {
     // Load model and tokenizer (cached after first load)
     const [model, tokenizer] = await Promise.all([
       getModel(),
       getTokenizer(),
     ]);
 
-    // Tokenize the text
-    const textInputs = await tokenizer(text, {
+    // Tokenize the whole batch, padded to its longest prompt
+    const textInputs = await tokenizer(batch.map((item) => item.text), {
       padding: true,
       truncation: true,
     });
 
-    // Generate text embeddings
+    // Generate text embeddings, one row per prompt
     const { text_embeds } = await model(textInputs);
-
-    // L2 normalize the embedding (same as image embeddings)
     const raw = text_embeds.data as Float32Array;
-    let sumSq = 0;
-    for (let i = 0; i < raw.length; i++) {
-      sumSq += raw[i] * raw[i];
+    const dims = raw.length / batch.length;
+
+    batch.forEach((item, row) => {
+      // L2 normalize the embedding (same as image embeddings)
+      const offset = row * dims;
+      let sumSq = 0;
+      for (let i = 0; i < dims; i++) {
+        sumSq += raw[offset + i] * raw[offset + i];
+      }
+      const norm = Math.sqrt(sumSq);
+      const embedding: number[] = [];
+      for (let i = 0; i < dims; i++) {
+        embedding.push(raw[offset + i] / norm);
+      }
+      item.resolve(embedding);
+    });
+  } catch (error) {
+    for (const item of batch) {
+      item.reject(error);
     }
-    const norm = Math.sqrt(sumSq);
-    const embedding: number[] = [];
-    for (let i = 0; i < raw.length; i++) {
-      embedding.push(raw[i] / norm);
+  }
+}
+
+// Query embeddings keyed by normalized text. The CLIP tokenizer lowercases and
+// collapses whitespace itself, so texts that differ only in those map to the same
+// embedding. Promises are cached so identical concurrent requests share one encode.
+const embeddingCache = new LRUCache<string, Promise<number[]>>(1024);
+
+function getEmbedding(text: string): Promise<number[]> {
+  const key = text.trim().toLowerCase().replace(/\s+/g, ' ');
+  const cached = embeddingCache.get(key);
+  if (cached) return cached;
+
+  const embedding = embedText(text);
+  embeddingCache.set(key, embedding);
+  // Don't keep failures around; the next request should retry
+  embedding.catch(() => embeddingCache.delete(key));
+  return embedding;
+}
+
+export async function POST(request: NextRequest) {
+  try {
+    const { text } = await request.json();
+
+    if (!text || typeof text !== 'string') {
+      return NextResponse.json(
+        { error: 'Missing or invalid "text" field' },
+        { status: 400 }
+      );
     }
 
+    const embedding = await getEmbedding(text);
+
     return NextResponse.json({
       embedding,
       dimensions: embedding.length,
@@ -1,3 +1,4 @@
+import { once } from 'node:events';
 import fs from 'node:fs';
 import path from 'node:path';
 import { fileURLToPath } from 'node:url';
@@ -11,6 +12,9 @@ const MONOREPO_ROOT = path.resolve(__dirname, '../../../../');
 const DEFAULT_INPUT = path.resolve(MONOREPO_ROOT, 'data/mtl_archives/manifest_enriched.jsonl');
 const DEFAULT_OUTPUT = path.resolve(MONOREPO_ROOT, 'data/mtl_archives/manifest_clean.jsonl');
 const DEFAULT_SUMMARY = path.resolve(MONOREPO_ROOT, 'data/mtl_archives/manifest_clean_summary.json');
+// Serialized lines are queued and handed to the output stream in chunks of this many rows
+const WRITE_BATCH_SIZE = 4096;
+const READ_CHUNK_SIZE = 1024 * 1024;
 
 const ABBREVIATION_MAP: Record<string, string> = {
   "s/o": "",
@@ -21,26 +25,54 @@ const ABBREVIATION_MAP: Record<string, string> = {
 };
 
 const PHOTO_SERIES_PATTERN = /Le reportage photographique comprend les lieux et bâtiments suivants\s*:?\s*(.+)/is;
+// matchAll() clones its pattern, so the global regexes below are safe to share
+const SERIES_LOCATION_PATTERN = /([^(]+?)\s*\((?:image|images)\s*[\d\s,-]+\)/gi;
+const SERIES_ENTRY_PATTERN = /([^(]+?)\s*\((?:image|images)\s*([\d\s,-]+)\)/gi;
+const DIGITS_PATTERN = /\d+/g;
+const IMAGE_RANGE_PATTERN = /(\d+)\s*-\s*(\d+)/g;
+const IMAGE_NUMBER_PATTERN = /image[_-](\d+)/i;
+const IMAGE_SUFFIX_PATTERN = /_(\d+)\.(jpg|jpeg|png|tif|tiff)$/i;
+const TRAILING_DOTS_PATTERN = /\.+$/;
+
+const NON_ASCII_PATTERN = /[^\x00-\x7F]/;
+const PUNCTUATION_PATTERN = /[\u2019\u2013\u2014]/g;
+const PUNCTUATION_MAP: Record<string, string> = {
+  "\u2019": "'",
+  "\u2013": "-",
+  "\u2014": "-",
+};
+const WHITESPACE_PATTERN = /\s+/g;
+// Any whitespace the collapse step would rewrite: non-space whitespace or a run of spaces
+const IRREGULAR_WHITESPACE_PATTERN = /[^\S ]| {2}/;
+const SANS_OBJET_PATTERN = /^Sans objet \(aucune description fournie\)\.\s*/i;
+// Stops at the first lowercase letter instead of building an uppercased copy
+const LOWERCASE_PATTERN = /\p{Ll}/u;
 
 function cleanText(value: unknown): string {
   if (value === null || value === undefined) {
     return "";
   }
   let text = String(value);
-  text = text.normalize("NFC");
-  text = text.replace(/\u2019/g, "'").replace(/\u2013/g, "-").replace(/\u2014/g, "-");
-  text = text.replace(/\s+/g, " ");
+  // NFC and the punctuation substitutions only affect non-ASCII input
+  if (NON_ASCII_PATTERN.test(text)) {
+    text = text.normalize("NFC");
+    text = text.replace(PUNCTUATION_PATTERN, (ch) => PUNCTUATION_MAP[ch]);
+  } else if (!IRREGULAR_WHITESPACE_PATTERN.test(text) && !SANS_OBJET_PATTERN.test(text)) {
+    // Already-clean ASCII (cotes, dates, most names): nothing left to rewrite
+    return text.trim();
+  }
+  text = text.replace(WHITESPACE_PATTERN, " ");
   // Remove "Sans objet" prefix
-  text = text.replace(/^Sans objet \(aucune description fournie\)\.\s*/i, "");
+  text = text.replace(SANS_OBJET_PATTERN, "");
   return text.trim();
 }
 
 function extractImageFromFilename(filename: string): number | null {
-  let match = filename.match(/image[_-](\d+)/i);
+  let match = filename.match(IMAGE_NUMBER_PATTERN);
   if (match) {
     return parseInt(match[1], 10);
   }
-  match = filename.match(/_(\d+)\.(jpg|jpeg|png|tif|tiff)$/i);
+  match = filename.match(IMAGE_SUFFIX_PATTERN);
   if (match) {
     return parseInt(match[1], 10);
   }
@@ -56,7 +88,7 @@ function parsePhotoSeries(description: string, imageNum: number | null = null):
   const content = match[1];
 
   if (imageNum === null) {
-    const locations = Array.from(content.matchAll(/([^(]+?)\s*\((?:image|images)\s*[\d\s,-]+\)/gi));
+    const locations = Array.from(content.matchAll(SERIES_LOCATION_PATTERN));
     if (locations.length > 0) {
       const cleanLocations = locations.map(m => m[1].trim()).filter(Boolean);
       return { 
@@ -67,19 +99,19 @@ function parsePhotoSeries(description: string, imageNum: number | null = null):
     return { text: content.slice(0, 200).trim() + "...", parsed: true };
   }
 
-  const entries = Array.from(content.matchAll(/([^(]+?)\s*\((?:image|images)\s*([\d\s,-]+)\)/gi));
+  const entries = Array.from(content.matchAll(SERIES_ENTRY_PATTERN));
 
   for (const entry of entries) {
     const location = entry[1].trim();
     const imageRange = entry[2];
     
     const numbers = new Set<number>();
-    const parts = imageRange.match(/\d+/g);
+    const parts = imageRange.match(DIGITS_PATTERN);
     if (parts) {
       parts.forEach(p => numbers.add(parseInt(p, 10)));
     }
     
-    const rangeMatches = imageRange.matchAll(/(\d+)\s*-\s*(\d+)/g);
+    const rangeMatches = imageRange.matchAll(IMAGE_RANGE_PATTERN);
     for (const rangeMatch of rangeMatches) {
       const start = parseInt(rangeMatch[1], 10);
       const end = parseInt(rangeMatch[2], 10);
@@ -131,24 +163,37 @@ function mergeDescriptions(primary: string, secondary: string): { value: string;
   return { value: "", source: "missing" };
 }
 
-function buildSyntheticDescription(record: any): string {
-  const name = cleanText(record.name);
-  const attributes = record.attributes || [];
-  const attrMap: Record<string, string> = {};
+/**
+ * Single-pass scan for the only traits the synthetic description reads,
+ * avoiding a throwaway attribute map per record.
+ */
+function pickDateAndCote(attributes: any[]): { date: unknown; cote: unknown } {
+  let date: unknown;
+  let cote: unknown;
   for (const attr of attributes) {
-    if (attr && typeof attr === 'object') {
-      attrMap[attr.trait_type] = attr.value;
+    if (!attr || typeof attr !== 'object') continue;
+    const trait = attr.trait_type;
+    if (trait === "Date") {
+      date = attr.value;
+    } else if (trait === "Cote") {
+      cote = attr.value;
     }
   }
-  
-  const dateValue = cleanText(attrMap["Date"]);
-  const coteValue = cleanText(attrMap["Cote"]);
+  return { date, cote };
+}
+
+function buildSyntheticDescription(record: any): string {
+  const name = cleanText(record.name);
+  const { date, cote } = pickDateAndCote(record.attributes || []);
+
+  const dateValue = cleanText(date);
+  const coteValue = cleanText(cote);
   const portal = record.portal_record || {};
   const locationHint = cleanText(portal["Lieu"]);
 
   const fragments: string[] = [];
   if (name) {
-    fragments.push(name.replace(/\.+$/, "") + ".");
+    fragments.push(name.replace(TRAILING_DOTS_PATTERN, "") + ".");
   } else {
     fragments.push("Photographie d'archive de Montréal.");
   }
@@ -165,8 +210,8 @@ function buildSyntheticDescription(record: any): string {
 
   if (fragments.length === 0 || fragments.join(" ").length < 48) {
     const extra = cleanText(portal["Description"]);
-    if (extra && !fragments.includes(extra.replace(/\.+$/, "") + ".")) {
-      fragments.push(extra.replace(/\.+$/, "") + ".");
+    if (extra && !fragments.includes(extra.replace(TRAILING_DOTS_PATTERN, "") + ".")) {
+      fragments.push(extra.replace(TRAILING_DOTS_PATTERN, "") + ".");
     }
   }
 
@@ -177,10 +222,29 @@ function buildSyntheticDescription(record: any): string {
   return composed;
 }
 
+const FRENCH_MARKERS = ["é", "è", "à", "ç", " qué", " montréal"];
+const ENGLISH_MARKERS = ["the ", " and ", "street", " avenue", "montreal"];
+
+/**
+ * Count non-overlapping occurrences of each marker with indexOf, without the
+ * throwaway arrays that split() allocates.
+ */
+function countMarkers(text: string, markers: string[]): number {
+  let count = 0;
+  for (const marker of markers) {
+    let index = text.indexOf(marker);
+    while (index !== -1) {
+      count++;
+      index = text.indexOf(marker, index + marker.length);
+    }
+  }
+  return count;
+}
+
 function heuristicLanguageGuess(value: string): string {
   const lower = value.toLowerCase();
-  const frenchMarkers = ["é", "è", "à", "ç", " qué", " montréal"].reduce((acc, marker) => acc + (lower.split(marker).length - 1), 0);
-  const englishMarkers = ["the ", " and ", "street", " avenue", "montreal"].reduce((acc, marker) => acc + (lower.split(marker).length - 1), 0);
+  const frenchMarkers = countMarkers(lower, FRENCH_MARKERS);
+  const englishMarkers = countMarkers(lower, ENGLISH_MARKERS);
   
   if (frenchMarkers > englishMarkers && frenchMarkers >= 1) return "fr";
   if (englishMarkers > frenchMarkers && englishMarkers >= 1) return "en";
@@ -192,8 +256,30 @@ function detectLanguageLabel(value: string): string {
   return heuristicLanguageGuess(value);
 }
 
+// Synthetic and templated descriptions repeat heavily, so memoize labels by text
+const LANGUAGE_CACHE_MAX = 4096;
+const languageCache = new Map<string, string>();
+
+function classifyLanguage(value: string): string {
+  const cached = languageCache.get(value);
+  if (cached !== undefined) return cached;
+
+  let language = detectLanguageLabel(value);
+  if (language === "unknown") {
+    language = heuristicLanguageGuess(value);
+  }
+  language = language || "unknown";
+
+  if (languageCache.size >= LANGUAGE_CACHE_MAX) {
+    languageCache.delete(languageCache.keys().next().value as string);
+  }
+  languageCache.set(value, language);
+  return language;
+}
+
 function enrichRecord(record: any): { cleaned: any; quality: any } {
-  const cleaned = { ...record };
+  // The caller hands over a freshly parsed record and discards it, so clean it in place
+  const cleaned = record;
   cleaned.metadata_schema_version = 1;
 
   const attributes = cleaned.attributes || [];
@@ -203,8 +289,11 @@ function enrichRecord(record: any): { cleaned: any; quality: any } {
       attrMap[attr.trait_type] = cleanText(attr.value);
     }
   }
-  // Filter out empty values
-  cleaned.attributes_map = Object.fromEntries(Object.entries(attrMap).filter(([_, v]) => v));
+  // Filter out empty values in place; a later duplicate trait can still blank an earlier one
+  for (const key in attrMap) {
+    if (!attrMap[key]) delete attrMap[key];
+  }
+  cleaned.attributes_map = attrMap;
 
   const portalRecord = { ...(cleaned.portal_record || {}) };
   for (const key of ["Titre", "Description", "Date", "Cote", "Mention de crédits", "Lieu"]) {
@@ -250,11 +339,7 @@ function enrichRecord(record: any): { cleaned: any; quality: any } {
   cleaned.description = descriptionValue;
   cleaned.description_source = descriptionSource;
   
-  let language = detectLanguageLabel(descriptionValue);
-  if (language === "unknown") {
-    language = heuristicLanguageGuess(descriptionValue);
-  }
-  cleaned.description_language = language || "unknown";
+  cleaned.description_language = classifyLanguage(descriptionValue);
   cleaned.portal_description_clean = portalDescription;
 
   const credits = cleanText(cleaned.credits || portalRecord["Mention de crédits"]);
@@ -266,7 +351,7 @@ function enrichRecord(record: any): { cleaned: any; quality: any } {
   const qualityFlags: string[] = [];
   if (syntheticUsed) qualityFlags.push("synthetic-description");
   if (descriptionValue.length < 50) qualityFlags.push("short-description");
-  if (descriptionValue === descriptionValue.toUpperCase() && descriptionValue) qualityFlags.push("uppercase-description");
+  if (descriptionValue && !LOWERCASE_PATTERN.test(descriptionValue)) qualityFlags.push("uppercase-description");
 
   cleaned.metadata_quality = {
     description_source: descriptionSource,
@@ -316,19 +401,22 @@ async function main() {
     quality_flag_counts: {} as Record<string, number>,
   };
 
-  const inputStream = fs.createReadStream(inputPath, { encoding: 'utf-8' });
+  const inputStream = fs.createReadStream(inputPath, { encoding: 'utf-8', highWaterMark: READ_CHUNK_SIZE });
   const outputStream = fs.createWriteStream(outputPath, { encoding: 'utf-8' });
 
-  // Read line by line
-  const readline = await import('readline');
-  const rl = readline.createInterface({
-    input: inputStream,
-    crlfDelay: Infinity
-  });
+  let pending: string[] = [];
+  const flush = async () => {
+    if (pending.length === 0) return;
+    const chunk = pending.join('');
+    pending = [];
+    if (!outputStream.write(chunk)) {
+      await once(outputStream, 'drain');
+    }
+  };
+
+  const processLine = (line: string) => {
+    if (!line.trim()) return;
 
-  for await (const line of rl) {
-    if (!line.trim()) continue;
-    
     try {
       const record = JSON.parse(line);
       const { cleaned, quality } = enrichRecord(record);
@@ -342,11 +430,32 @@ async function main() {
         summary.quality_flag_counts[flag] = (summary.quality_flag_counts[flag] || 0) + 1;
       }
       
-      outputStream.write(JSON.stringify(cleaned) + '\n');
+      pending.push(JSON.stringify(cleaned) + '\n');
     } catch (err) {
       console.error("Failed to process line:", err);
     }
+  };
+
+  // Split chunks on '\n' directly; a trailing '\r' is whitespace to JSON.parse
+  let remainder = '';
+  for await (const chunk of inputStream) {
+    const text = remainder + chunk;
+    let start = 0;
+    let newline = text.indexOf('\n');
+    while (newline !== -1) {
+      processLine(text.slice(start, newline));
+      start = newline + 1;
+      newline = text.indexOf('\n', start);
+    }
+    remainder = text.slice(start);
+    if (pending.length >= WRITE_BATCH_SIZE) {
+      await flush();
+    }
   }
+  processLine(remainder);
+  await flush();
+  outputStream.end();
+  await once(outputStream, 'finish');
 
   fs.writeFileSync(summaryPath, JSON.stringify(summary, null, 2), 'utf-8');
   console.log(`Wrote cleaned manifest to ${outputPath}`);
@@ -1,5 +1,6 @@
 import fs from 'node:fs';
 import path from 'node:path';
+import readline from 'node:readline';
 import { fileURLToPath } from 'node:url';
 import { parseArgs } from 'node:util';
 import dotenv from 'dotenv';
@@ -20,9 +21,13 @@ const VLM_MANIFEST_PATH = path.resolve(MONOREPO_ROOT, 'data/mtl_archives/manifes
 const CLEAN_MANIFEST_PATH = path.resolve(MONOREPO_ROOT, 'data/mtl_archives/manifest_clean.jsonl');
 const MANIFEST_PATH = fs.existsSync(VLM_MANIFEST_PATH) ? VLM_MANIFEST_PATH : CLEAN_MANIFEST_PATH;
 const OUTPUT_PATH = path.resolve(MONOREPO_ROOT, 'data/mtl_archives/embeddings_2d.json');
+// Cache: ids + dimensions as JSON, vector values as a raw little-endian float32 matrix
 const CACHE_PATH = path.resolve(MONOREPO_ROOT, 'data/mtl_archives/vectors_cache.json');
+const CACHE_VALUES_PATH = path.resolve(MONOREPO_ROOT, 'data/mtl_archives/vectors_cache.f32');
 
 const BATCH_SIZE = 20;
+const FETCH_CONCURRENCY = Number(process.env.VECTORIZE_FETCH_CONCURRENCY || '4');
+const MAX_RETRIES = 5;
 
 if (!ACCOUNT_ID || !API_TOKEN) {
   console.error('Missing Cloudflare credentials.');
@@ -31,55 +36,119 @@ if (!ACCOUNT_ID || !API_TOKEN) {
 
 async function fetchVectorsByIds(ids: string[]) {
   const url = `https://api.cloudflare.com/client/v4/accounts/${ACCOUNT_ID}/vectorize/v2/indexes/${VECTORIZE_INDEX}/get_by_ids`;
-  
-  const response = await fetch(url, {
-    method: 'POST',
-    headers: {
-      'Authorization': `Bearer ${API_TOKEN}`,
-      'Content-Type': 'application/json',
-    },
-    body: JSON.stringify({ ids }),
-  });
 
-  if (!response.ok) {
-    throw new Error(`Vectorize fetch failed: ${response.status}`);
-  }
+  for (let attempt = 0; ; attempt++) {
+    const response = await fetch(url, {
+      method: 'POST',
+      headers: {
+        'Authorization': `Bearer ${API_TOKEN}`,
+        'Content-Type': 'application/json',
+      },
+      body: JSON.stringify({ ids }),
+    });
+
+    // Back off only when the API asks us to, honoring Retry-After when present
+    if (response.status === 429 && attempt < MAX_RETRIES) {
+      const retryAfter = Number(response.headers.get('retry-after'));
+      const delayMs = retryAfter > 0 ? retryAfter * 1000 : 500 * 2 ** attempt;
+      await new Promise(r => setTimeout(r, delayMs));
+      continue;
+    }
+
+    if (!response.ok) {
+      throw new Error(`Vectorize fetch failed: ${response.status}`);
+    }
 
-  const json = await response.json() as any;
-  return json.result || [];
+    const json = await response.json() as any;
+    return json.result || [];
+  }
 }
 
 async function fetchAllVectors(manifest: any[]) {
   const ids = manifest.map(r => r.metadata_filename).filter(Boolean);
   const total = ids.length;
-  console.log(`Fetching ${total} vectors from Vectorize...`);
+  console.log(`Fetching ${total} vectors from Vectorize (${FETCH_CONCURRENCY} concurrent requests)...`);
+
+  const batches: string[][] = [];
+  for (let i = 0; i < total; i += BATCH_SIZE) {
+    batches.push(ids.slice(i, i + BATCH_SIZE));
+  }
+
+  // Results are stored per batch index so the output order matches the manifest
+  const batchResults: any[][] = new Array(batches.length);
+  let nextBatch = 0;
+  let fetched = 0;
+  let valid = 0;
+
+  async function worker() {
+    while (nextBatch < batches.length) {
+      const index = nextBatch++;
+      try {
+        const results = await fetchVectorsByIds(batches[index]);
+        batchResults[index] = results;
+        valid += results.filter((vec: any) => vec.values && vec.values.length > 0).length;
+      } catch (err) {
+        console.error(`\nBatch failed:`, err);
+        batchResults[index] = [];
+      }
+      fetched += batches[index].length;
+      process.stdout.write(`\rFetched ${fetched}/${total} (${valid} valid)`);
+    }
+  }
+
+  await Promise.all(Array.from({ length: Math.min(FETCH_CONCURRENCY, batches.length) }, worker));
 
   const allVectors: number[][] = [];
   const validIds: string[] = [];
-
-  for (let i = 0; i < total; i += BATCH_SIZE) {
-    const batchIds = ids.slice(i, i + BATCH_SIZE);
-    try {
-      const results = await fetchVectorsByIds(batchIds);
-      
-      for (const vec of results) {
-        if (vec.values && vec.values.length > 0) {
-          allVectors.push(vec.values);
-          validIds.push(vec.id);
-        }
+  for (const results of batchResults) {
+    for (const vec of results) {
+      if (vec.values && vec.values.length > 0) {
+        allVectors.push(vec.values);
+        validIds.push(vec.id);
       }
-      
-      process.stdout.write(`\rFetched ${Math.min(i + BATCH_SIZE, total)}/${total} (${allVectors.length} valid)`);
-      // Rate limiting
-      await new Promise(r => setTimeout(r, 200));
-    } catch (err) {
-      console.error(`\nBatch failed:`, err);
     }
   }
   console.log('\nFetch complete.');
   return { vectors: allVectors, ids: validIds };
 }
 
+/**
+ * Parse the manifest line by line instead of reading the whole file into one string.
+ */
+async function loadManifest(manifestPath: string): Promise<any[]> {
+  const records: any[] = [];
+  const rl = readline.createInterface({ input: fs.createReadStream(manifestPath), crlfDelay: Infinity });
+  for await (const line of rl) {
+    if (line.trim()) records.push(JSON.parse(line));
+  }
+  return records;
+}
+
+/**
+ * Vectorize stores float32, so a binary float32 matrix is a lossless cache at a
+ * fraction of the size of the equivalent JSON number arrays.
+ */
+function writeVectorCache(vectors: number[][], ids: string[]) {
+  const dimensions = vectors[0].length;
+  const matrix = new Float32Array(vectors.length * dimensions);
+  vectors.forEach((vec, row) => matrix.set(vec, row * dimensions));
+  fs.writeFileSync(CACHE_VALUES_PATH, new Uint8Array(matrix.buffer));
+  fs.writeFileSync(CACHE_PATH, JSON.stringify({ ids, dimensions }));
+}
+
+function readVectorCache(): { vectors: number[][]; ids: string[] } {
+  const { ids, dimensions } = JSON.parse(fs.readFileSync(CACHE_PATH, 'utf-8'));
+  const bytes = fs.readFileSync(CACHE_VALUES_PATH);
+  // Float32Array views need 4-byte alignment; copy if Node handed back an offset slice
+  const aligned = bytes.byteOffset % 4 === 0 ? bytes : new Uint8Array(bytes);
+  const matrix = new Float32Array(aligned.buffer, aligned.byteOffset, aligned.byteLength / 4);
+  const vectors: number[][] = [];
+  for (let row = 0; row < ids.length; row++) {
+    vectors.push(Array.from(matrix.subarray(row * dimensions, (row + 1) * dimensions)));
+  }
+  return { vectors, ids };
+}
+
 function runUMAP(vectors: number[][]) {
   console.log(`Running UMAP on ${vectors.length} vectors...`);
   
@@ -93,19 +162,23 @@ function runUMAP(vectors: number[][]) {
 
   const embedding = umap.fit(vectors);
   
-  // Normalize to 0-1
+  // Normalize to 0-1 in place: one pass for the bounds, one to rescale
   let minX = Infinity, maxX = -Infinity, minY = Infinity, maxY = -Infinity;
   for (const point of embedding) {
-    minX = Math.min(minX, point[0]);
-    maxX = Math.max(maxX, point[0]);
-    minY = Math.min(minY, point[1]);
-    maxY = Math.max(maxY, point[1]);
+    const x = point[0], y = point[1];
+    if (x < minX) minX = x;
+    if (x > maxX) maxX = x;
+    if (y < minY) minY = y;
+    if (y > maxY) maxY = y;
   }
 
-  return embedding.map(p => [
-    (p[0] - minX) / (maxX - minX),
-    (p[1] - minY) / (maxY - minY)
-  ]);
+  const rangeX = maxX - minX;
+  const rangeY = maxY - minY;
+  for (const point of embedding) {
+    point[0] = (point[0] - minX) / rangeX;
+    point[1] = (point[1] - minY) / rangeY;
+  }
+  return embedding;
 }
 
 async function main() {
@@ -113,6 +186,7 @@ async function main() {
     args: process.argv.slice(2),
     options: {
       'skip-fetch': { type: 'boolean' },
+      pretty: { type: 'boolean' },
     },
   });
 
@@ -121,26 +195,21 @@ async function main() {
     process.exit(1);
   }
 
-  const manifest = fs.readFileSync(MANIFEST_PATH, 'utf-8')
-    .split('\n')
-    .filter(Boolean)
-    .map(l => JSON.parse(l));
+  const manifest = await loadManifest(MANIFEST_PATH);
 
   let vectors: number[][] = [];
   let ids: string[] = [];
 
-  if (values['skip-fetch'] && fs.existsSync(CACHE_PATH)) {
+  if (values['skip-fetch'] && fs.existsSync(CACHE_PATH) && fs.existsSync(CACHE_VALUES_PATH)) {
     console.log('Loading cached vectors...');
-    const cache = JSON.parse(fs.readFileSync(CACHE_PATH, 'utf-8'));
-    vectors = cache.vectors;
-    ids = cache.ids;
+    ({ vectors, ids } = readVectorCache());
   } else {
     const result = await fetchAllVectors(manifest);
     vectors = result.vectors;
     ids = result.ids;
 
     if (vectors.length > 0) {
-      fs.writeFileSync(CACHE_PATH, JSON.stringify({ vectors, ids }));
+      writeVectorCache(vectors, ids);
       console.log(`Cached vectors to ${CACHE_PATH}`);
     }
   }
@@ -175,7 +244,7 @@ async function main() {
     };
   });
 
-  fs.writeFileSync(OUTPUT_PATH, JSON.stringify(output, null, 2));
+  fs.writeFileSync(OUTPUT_PATH, values.pretty ? JSON.stringify(output, null, 2) : JSON.stringify(output));
   console.log(`Saved ${output.length} points to ${OUTPUT_PATH}`);
 }
 
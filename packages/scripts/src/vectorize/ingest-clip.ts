@@ -1,3 +1,4 @@
+import { createHash } from 'node:crypto';
 import fs from 'node:fs';
 import path from 'node:path';
 import { fileURLToPath } from 'node:url';
@@ -26,9 +27,20 @@ const VECTORIZE_ENDPOINT = `https://api.cloudflare.com/client/v4/accounts/${ACCO
 // Configuration
 const DEFAULT_INPUT = path.resolve(MONOREPO_ROOT, 'data/mtl_archives/manifest_clean.jsonl');
 const BATCH_SIZE = parseInt(process.env.CLIP_BATCH_SIZE || "8", 10);
+const MAX_INFLIGHT_UPSERTS = parseInt(process.env.CLIP_MAX_INFLIGHT_UPSERTS || "4", 10);
+
+/**
+ * Vectorize stores float32, so print each value with the 9 significant digits
+ * that round-trip a float32 exactly instead of a full float64 expansion.
+ */
+function compactFloat32(value: number): number {
+  return Number(Math.fround(value).toPrecision(9));
+}
 
 async function upsertVectors(vectors: any[]) {
-  const ndjson = vectors.map(v => JSON.stringify(v)).join('\n');
+  const ndjson = vectors
+    .map(v => JSON.stringify({ ...v, values: Array.from(v.values, compactFloat32) }))
+    .join('\n');
   const response = await fetch(VECTORIZE_ENDPOINT, {
     method: 'POST',
     headers: {
@@ -46,6 +58,77 @@ async function upsertVectors(vectors: any[]) {
   return true;
 }
 
+function resolveImageUrl(record: any): string | null {
+  if (record.external_url) return record.external_url;
+  const img = record.resolved_image_filename || record.image_filename;
+  if (img && R2_PUBLIC_DOMAIN) return `https://${R2_PUBLIC_DOMAIN}/${img}`;
+  return null;
+}
+
+type LoadedImage = { hash: string; image: RawImage | null };
+
+// Embeddings keyed by SHA-1 of the image bytes; records sharing a file reuse one encode
+const embeddingCache = new Map<string, Float32Array>();
+
+/**
+ * Download every image in a batch concurrently; failed or missing images are null.
+ * Images whose bytes were already encoded are hashed but not decoded.
+ */
+async function loadImages(batch: any[]): Promise<(LoadedImage | null)[]> {
+  return Promise.all(batch.map(async (record) => {
+    const url = resolveImageUrl(record);
+    if (!url) return null;
+    try {
+      const response = await fetch(url);
+      if (!response.ok) return null;
+      const bytes = Buffer.from(await response.arrayBuffer());
+      const hash = createHash('sha1').update(bytes).digest('hex');
+      if (embeddingCache.has(hash)) return { hash, image: null };
+      return { hash, image: await RawImage.fromBlob(new Blob([bytes])) };
+    } catch (err) {
+      // console.error(`Failed to fetch ${url}:`, err); // Verbose
+      return null;
+    }
+  }));
+}
+
+/**
+ * Encode a batch of images with a single CLIP forward pass and return one
+ * L2-normalized embedding per image.
+ */
+async function embedImages(model: any, processor: any, images: RawImage[]): Promise<Float32Array[]> {
+  const imageInputs = await processor(images);
+  const { image_embeds } = await model(imageInputs);
+
+  // Normalize each row into its own Float32Array; values stay as float32 until upsert
+  const raw = image_embeds.data as Float32Array;
+  const dim = raw.length / images.length;
+  const embeddings: Float32Array[] = [];
+  for (let row = 0; row < images.length; row++) {
+    const values = raw.slice(row * dim, (row + 1) * dim);
+    let sumSq = 0;
+    for (let k = 0; k < dim; k++) sumSq += values[k] * values[k];
+    const norm = Math.sqrt(sumSq);
+    for (let k = 0; k < dim; k++) values[k] /= norm;
+    embeddings.push(values);
+  }
+  return embeddings;
+}
+
+function buildVector(record: any, values: Float32Array) {
+  const metadata: any = {};
+  if (record.name) metadata.name = record.name;
+  if (record.attributes_map?.Date) metadata.date = record.attributes_map.Date;
+  const imageKey = record.resolved_image_filename || record.image_filename;
+  if (imageKey) metadata.image = imageKey;
+
+  return {
+    id: record.metadata_filename,
+    values,
+    metadata
+  };
+}
+
 async function main() {
   const { values } = parseArgs({
     args: process.argv.slice(2),
@@ -84,76 +167,94 @@ async function main() {
     subset = subset.slice(0, limit);
   }
 
+  // Drop records without any image source up front so every batch is full of encodable images
+  const withImage = subset.filter(record => resolveImageUrl(record) !== null);
+  const noImage = subset.length - withImage.length;
+  if (noImage > 0) {
+    console.log(`Skipping ${noImage} records with no image URL`);
+  }
+  subset = withImage;
+
   console.log(`Processing ${subset.length} records...`);
 
   let processed = 0;
-  let skipped = 0;
+  let skipped = noImage;
+  const inFlight = new Set<Promise<void>>();
+
+  let pending = subset.length > 0 ? loadImages(subset.slice(0, BATCH_SIZE)) : null;
 
   for (let i = 0; i < subset.length; i += BATCH_SIZE) {
     const batch = subset.slice(i, i + BATCH_SIZE);
-    const vectors: any[] = [];
-    
-    // Process batch in parallel
-    const promises = batch.map(async (record) => {
-      let url = record.external_url;
-      if (!url && R2_PUBLIC_DOMAIN) {
-        const img = record.resolved_image_filename || record.image_filename;
-        if (img) url = `https://${R2_PUBLIC_DOMAIN}/${img}`;
-      }
+    const images = await pending!;
+
+    // Prefetch the next batch so downloads overlap with encoding and upserting this one
+    const next = i + BATCH_SIZE;
+    pending = next < subset.length ? loadImages(subset.slice(next, next + BATCH_SIZE)) : null;
 
-      if (!url) return null;
+    const loaded = batch
+      .map((record, idx) => ({ record, loaded: images[idx] }))
+      .filter((entry): entry is { record: any; loaded: LoadedImage } => entry.loaded !== null);
 
+    // Encode each distinct image once; duplicates and earlier hits come from the cache
+    const toEncode = new Map<string, RawImage>();
+    for (const { loaded: { hash, image } } of loaded) {
+      if (image && !embeddingCache.has(hash)) toEncode.set(hash, image);
+    }
+
+    if (toEncode.size > 0) {
+      const hashes = Array.from(toEncode.keys());
       try {
-        const image = await RawImage.read(url);
-        const image_inputs = await processor(image);
-        const { image_embeds } = await model(image_inputs);
-        
-        // Normalize embedding (l2 norm)
-        // tensor.data is a Float32Array. We need to convert it to a regular array.
-        // Also need to implement manual normalization if transformers.js doesn't do it automatically for this model (CLIP usually outputs raw features).
-        // For simplicity here we assume raw features.
-        
-        // Manual L2 normalization
-        const raw = image_embeds.data;
-        let sumSq = 0;
-        for (let k = 0; k < raw.length; k++) sumSq += raw[k] * raw[k];
-        const norm = Math.sqrt(sumSq);
-        const values = [];
-        for (let k = 0; k < raw.length; k++) values.push(raw[k] / norm);
-
-        const metadata: any = {};
-        if (record.name) metadata.name = record.name;
-        if (record.attributes_map?.Date) metadata.date = record.attributes_map.Date;
-        const imageKey = record.resolved_image_filename || record.image_filename;
-        if (imageKey) metadata.image = imageKey;
-
-        return {
-          id: record.metadata_filename,
-          values: values,
-          metadata
-        };
+        const embeddings = await embedImages(model, processor, Array.from(toEncode.values()));
+        hashes.forEach((hash, idx) => embeddingCache.set(hash, embeddings[idx]));
       } catch (err) {
-        // console.error(`Failed to process ${url}:`, err); // Verbose
-        return null;
+        // One bad image fails the whole batch; retry individually so the rest still land
+        for (const hash of hashes) {
+          try {
+            const [embedding] = await embedImages(model, processor, [toEncode.get(hash)!]);
+            embeddingCache.set(hash, embedding);
+          } catch (err) {
+            // console.error(`Failed to encode image ${hash}:`, err); // Verbose
+          }
+        }
       }
-    });
+    }
 
-    const results = await Promise.all(promises);
-    const validVectors = results.filter(v => v !== null);
+    const validVectors: any[] = [];
+    for (const entry of loaded) {
+      const embedding = embeddingCache.get(entry.loaded.hash);
+      if (embedding) validVectors.push(buildVector(entry.record, embedding));
+    }
 
     if (validVectors.length > 0) {
-      if (await upsertVectors(validVectors)) {
-        processed += validVectors.length;
-        skipped += (batch.length - validVectors.length);
-        process.stdout.write(`\rProcessed: ${processed}, Skipped: ${skipped}`);
-      } else {
-        skipped += batch.length;
+      // Upload in the background so encoding the next batch doesn't wait on the network
+      const batchLength = batch.length;
+      const upload: Promise<void> = upsertVectors(validVectors)
+        .catch((err) => {
+          console.error(`\nVectorize upsert failed: ${err}`);
+          return false;
+        })
+        .then((ok) => {
+          if (ok) {
+            processed += validVectors.length;
+            skipped += (batchLength - validVectors.length);
+            process.stdout.write(`\rProcessed: ${processed}, Skipped: ${skipped}`);
+          } else {
+            skipped += batchLength;
+          }
+        })
+        .finally(() => inFlight.delete(upload));
+      inFlight.add(upload);
+
+      if (inFlight.size >= MAX_INFLIGHT_UPSERTS) {
+        await Promise.race(inFlight);
       }
     } else {
       skipped += batch.length;
     }
   }
 
+  await Promise.all(inFlight);
+
   console.log(`\nComplete. Processed: ${processed}, Skipped: ${skipped}`);
 }
 
@@ -20,11 +20,19 @@ Output format:
 """
 
 import argparse
-import json
+import mmap
 import re
 import sys
+from functools import lru_cache
 from pathlib import Path
 
+# Shared JSONL helpers live one level up, in pipelines/
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from jsonl_io import dump_line, load_json
+
+# Flush output once this many encoded bytes are buffered
+WRITE_CHUNK_BYTES = 4 * 1024 * 1024
+
 # French month mappings
 FRENCH_MONTHS = {
     'janvier': '01', 'jan': '01', 'janv': '01',
@@ -41,6 +49,57 @@ FRENCH_MONTHS = {
     'décembre': '12', 'decembre': '12', 'déc': '12', 'dec': '12',
 }
 
+# Anchored date shapes in one alternation, tried left to right in a single
+# match; parse_date dispatches on the name of the branch that matched
+DATE_RE = re.compile(
+    r'(?P<decade>[Dd]écennie\s+(\d{4}))'                        # "Décennie 1930"
+    r'|(?P<range>(\d{4})\s*[-–]\s*(\d{2,4})$)'                  # "1947-1949", "1925-35"
+    r'|(?P<year>\d{4}$)'                                          # "1966"
+    r'|(?i:(?P<dmy>(\d{1,2})[-\s]([a-zéûô]+)\.?[-\s](\d{2,4})$))'  # "26-mars-36", "08-avr.-36"
+    r'|(?i:(?P<full>\d{1,2}(?:er|e|ème)?\s+[a-zéûô]+\s+(\d{4})$))'  # "24 juin 1925", "1er avril 1936"
+    r'|(?i:(?P<month_year>[a-zéûô]+\s+(\d{4})$))'                # "avril 1936"
+    r'|(?i:(?P<abbrev>[a-zéûô]+\.?[-\s](\d{2})$))'                # "avr.-25"
+)
+DECADE_PREFIXES = ('Décennie ', 'décennie ')
+FRENCH_FULL_RE = re.compile(r'^(\d{1,2})(?:er|e|ème)?\s+([a-zéûô]+)\s+(\d{4})$', re.IGNORECASE)
+END_DATE_RE = re.compile(r'[-–]\s*(\d{1,2})\s+([a-zéûô]+)\s+(\d{4})\s*$', re.IGNORECASE)
+YEAR_ANY_RE = re.compile(r'(\d{4})')
+
+
+def iter_jsonl_lines(path: Path):
+    """Yield the non-blank lines of a JSONL file as bytes, via a read-only mmap."""
+    with open(path, 'rb') as f:
+        if f.seek(0, 2) == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = 0
+            size = len(mm)
+            while start < size:
+                end = mm.find(b'\n', start)
+                if end == -1:
+                    end = size
+                line = mm[start:end]
+                start = end + 1
+                if line.strip():
+                    yield line
+
+
+def write_jsonl(path: Path, records) -> None:
+    """Write records as JSONL, flushing encoded lines in large chunks."""
+    buf: list[bytes] = []
+    size = 0
+    with open(path, 'wb') as f:
+        for record in records:
+            line = dump_line(record)
+            buf.append(line)
+            size += len(line)
+            if size >= WRITE_CHUNK_BYTES:
+                f.write(b''.join(buf))
+                buf.clear()
+                size = 0
+        if buf:
+            f.write(b''.join(buf))
+
 
 def normalize_year(year_str: str) -> str | None:
     """Convert 2-digit or 4-digit year to 4-digit."""
@@ -60,6 +119,9 @@ def normalize_year(year_str: str) -> str | None:
     return None
 
 
+# A manifest repeats a few hundred distinct date strings across all of its
+# records, so each one only needs parsing once
+@lru_cache(maxsize=4096)
 def parse_date(date_str: str) -> str | None:
     """
     Parse various date formats and return normalized form.
@@ -75,68 +137,59 @@ def parse_date(date_str: str) -> str | None:
 
     date_str = date_str.strip()
 
-    # Pattern: "Décennie 1930" or "Décennie 1920"
-    decade_match = re.match(r'[Dd]écennie\s+(\d{4})', date_str)
-    if decade_match:
-        return f"{decade_match.group(1)}s"
-
-    # Pattern: "1947-1949" (year range)
-    range_match = re.match(r'^(\d{4})\s*[-–]\s*(\d{4})$', date_str)
-    if range_match:
-        return f"{range_match.group(1)}-{range_match.group(2)}"
-
-    # Pattern: "1925-1935" (year range, alternate)
-    range_match2 = re.match(r'^(\d{4})\s*[-–]\s*(\d{2,4})$', date_str)
-    if range_match2:
-        start = range_match2.group(1)
-        end = range_match2.group(2)
+    # Fast path for the common shapes, without entering the regex engine.
+    # isdecimal() accepts exactly the digits that \d does.
+    length = len(date_str)
+    if length == 4 and date_str.isdecimal():
+        return date_str
+    if length == 9 and date_str[4] == '-' and date_str[:4].isdecimal() and date_str[5:].isdecimal():
+        return date_str
+    if date_str.startswith(DECADE_PREFIXES) and date_str[9:13].isdecimal() and len(date_str[9:13]) == 4:
+        return f"{date_str[9:13]}s"
+
+    match = DATE_RE.match(date_str)
+    kind = match.lastgroup if match else None
+
+    if kind == 'decade':
+        return f"{match.group(2)}s"
+
+    if kind == 'range':
+        start, end = match.group(4), match.group(5)
         if len(end) == 2:
             end = start[:2] + end
         return f"{start}-{end}"
 
-    # Pattern: Single year "1966"
-    year_match = re.match(r'^(\d{4})$', date_str)
-    if year_match:
-        return year_match.group(1)
-
-    # Pattern: "26-mars-36" or "08-avr.-36"
-    french_dmy = re.match(r'^(\d{1,2})[-\s]([a-zéûô]+)\.?[-\s](\d{2,4})$', date_str, re.IGNORECASE)
-    if french_dmy:
-        day = french_dmy.group(1).zfill(2)
-        month_str = french_dmy.group(2).lower().rstrip('.')
-        year_str = french_dmy.group(3)
-
-        month = FRENCH_MONTHS.get(month_str)
-        year = normalize_year(year_str)
+    if kind == 'year':
+        return match.group(6)
 
+    if kind == 'dmy':
+        month = FRENCH_MONTHS.get(match.group(9).lower().rstrip('.'))
+        year = normalize_year(match.group(10))
         if month and year:
             return year  # Return just the year for simplicity
+        # Not a known month, but the same text can still read as "12 foo 1936"
+        french_full = FRENCH_FULL_RE.match(date_str)
+        if french_full:
+            return french_full.group(3)
 
-    # Pattern: "24 juin 1925" or "1er avril 1936"
-    french_full = re.match(r'^(\d{1,2})(?:er|e|ème)?\s+([a-zéûô]+)\s+(\d{4})$', date_str, re.IGNORECASE)
-    if french_full:
-        year = french_full.group(3)
-        return year  # Return just the year
+    if kind == 'full':
+        return match.group(12)  # Return just the year
 
-    # Pattern: "avril 1936" (month year)
-    month_year = re.match(r'^([a-zéûô]+)\s+(\d{4})$', date_str, re.IGNORECASE)
-    if month_year:
-        return month_year.group(2)  # Return just the year
+    if kind == 'month_year':
+        return match.group(14)  # Return just the year
+
+    if kind == 'abbrev':
+        year = normalize_year(match.group(16))
+        if year:
+            return year
 
     # Pattern: Complex string with date at end: "... - 2 mai 1964"
-    end_date = re.search(r'[-–]\s*(\d{1,2})\s+([a-zéûô]+)\s+(\d{4})\s*$', date_str, re.IGNORECASE)
+    end_date = END_DATE_RE.search(date_str)
     if end_date:
         return end_date.group(3)  # Return just the year
 
-    # Pattern: Just month-year at end: "avr.-25"
-    abbrev_month_year = re.match(r'^([a-zéûô]+)\.?[-\s](\d{2})$', date_str, re.IGNORECASE)
-    if abbrev_month_year:
-        year = normalize_year(abbrev_month_year.group(2))
-        if year:
-            return year
-
     # Last resort: extract any 4-digit year
-    year_anywhere = re.search(r'(\d{4})', date_str)
+    year_anywhere = YEAR_ANY_RE.search(date_str)
     if year_anywhere:
         year = int(year_anywhere.group(1))
         if 1800 <= year <= 2100:
@@ -161,48 +214,64 @@ def main():
 
     print(f"Reading from: {input_path}")
 
-    records = []
-    with open(input_path, 'r') as f:
-        for line in f:
-            if line.strip():
-                records.append(json.loads(line))
-
-    print(f"Total records: {len(records)}")
-
     # Stats
+    total_records = 0
     already_has_date = 0
     extracted_date = 0
     no_date_source = 0
     parse_failed = 0
     failed_examples = []
+    samples = []
+
+    def normalized_records():
+        """Stream records from the input, filling in date_value as they pass."""
+        nonlocal total_records, already_has_date, extracted_date, no_date_source, parse_failed
+
+        for line in iter_jsonl_lines(input_path):
+            record = load_json(line)
+            total_records += 1
+
+            # Check if already has date_value
+            if record.get('date_value'):
+                already_has_date += 1
+            else:
+                # Try to extract from attributes_map.Date
+                raw_date = None
+                if record.get('attributes_map') and record['attributes_map'].get('Date'):
+                    raw_date = record['attributes_map']['Date']
+                elif record.get('portal_date'):
+                    raw_date = record['portal_date']
+
+                if not raw_date:
+                    no_date_source += 1
+                else:
+                    # Parse and normalize
+                    normalized = parse_date(raw_date)
+
+                    if normalized:
+                        record['date_value'] = normalized
+                        extracted_date += 1
+                    else:
+                        parse_failed += 1
+                        if len(failed_examples) < 10:
+                            failed_examples.append(raw_date)
+
+            if len(samples) < 10 and record.get('date_value'):
+                samples.append((record.get('attributes_map', {}).get('Date', 'N/A'), record['date_value']))
+
+            yield record
+
+    if args.dry_run:
+        for _ in normalized_records():
+            pass
+    else:
+        # Write next to the output and swap it in at the end, so the input
+        # can safely be the output path
+        tmp_path = output_path.with_name(output_path.name + '.tmp')
+        write_jsonl(tmp_path, normalized_records())
+        tmp_path.replace(output_path)
 
-    for record in records:
-        # Check if already has date_value
-        if record.get('date_value'):
-            already_has_date += 1
-            continue
-
-        # Try to extract from attributes_map.Date
-        raw_date = None
-        if record.get('attributes_map') and record['attributes_map'].get('Date'):
-            raw_date = record['attributes_map']['Date']
-        elif record.get('portal_date'):
-            raw_date = record['portal_date']
-
-        if not raw_date:
-            no_date_source += 1
-            continue
-
-        # Parse and normalize
-        normalized = parse_date(raw_date)
-
-        if normalized:
-            record['date_value'] = normalized
-            extracted_date += 1
-        else:
-            parse_failed += 1
-            if len(failed_examples) < 10:
-                failed_examples.append(raw_date)
+    print(f"Total records: {total_records}")
 
     print(f"\n=== Results ===")
     print(f"Already had date_value: {already_has_date}")
@@ -217,23 +286,14 @@ def main():
 
     # Sample of extracted dates
     print(f"\nSample of extracted dates:")
-    count = 0
-    for r in records:
-        if r.get('date_value') and count < 10:
-            raw = r.get('attributes_map', {}).get('Date', 'N/A')
-            print(f"  {raw} → {r['date_value']}")
-            count += 1
+    for raw, date_value in samples:
+        print(f"  {raw} → {date_value}")
 
     if args.dry_run:
         print("\n[Dry run - no files written]")
         return
 
-    # Write output
-    with open(output_path, 'w') as f:
-        for record in records:
-            f.write(json.dumps(record) + '\n')
-
-    print(f"\nWrote {len(records)} records to {output_path}")
+    print(f"\nWrote {total_records} records to {output_path}")
 
 
 if __name__ == '__main__':
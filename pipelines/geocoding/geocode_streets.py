@@ -3,21 +3,32 @@
 Geocode street names from MTL Archives manifest using Mapbox Geocoding API.
 
 Usage:
-    python geocode_streets.py [--dry-run] [--limit N]
+    python geocode_streets.py [--dry-run] [--limit N] [--offset N] [--resume]
 
 Environment:
     MAP_BOX_TOKEN: Mapbox API access token
 """
 
+import http.client
 import json
 import os
 import re
+import sqlite3
 import sys
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from pathlib import Path
 from urllib.parse import quote
-from urllib.request import urlopen, Request
-from urllib.error import HTTPError, URLError
+
+# Shared JSONL helpers live one level up, in pipelines/
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from jsonl_io import dump_line, load_json, resume_point
+
+MAPBOX_HOST = "api.mapbox.com"
+USER_AGENT = "mtl-archives-geocoder/1.0"
 
 # Montreal bounding box (SW lng, SW lat, NE lng, NE lat)
 MONTREAL_BBOX = "-73.98,45.40,-73.47,45.70"
@@ -25,7 +36,25 @@ MONTREAL_BBOX = "-73.98,45.40,-73.47,45.70"
 # Rate limiting: Mapbox free tier allows 100k requests/month
 # We'll do ~10 requests/second to be safe
 REQUESTS_PER_SECOND = 10
-REQUEST_DELAY = 1.0 / REQUESTS_PER_SECOND
+
+# Requests that may start back to back after an idle spell (cache hits, retry backoff)
+REQUEST_BURST = 10
+
+# Requests in flight at once; the rate limiter still caps starts per second
+REQUEST_CONCURRENCY = 10
+
+# Requests submitted ahead of the writer; bounds what an interrupted run leaves queued
+REQUEST_WINDOW = REQUEST_CONCURRENCY * 4
+
+# Retries for 429/5xx responses, backing off exponentially from RETRY_BACKOFF seconds
+MAX_RETRIES = 3
+RETRY_BACKOFF = 1.0
+
+# Flush the output file after this many geocoded records so a crash keeps the work done
+FLUSH_EVERY = 500
+
+# Commit cached geocoding responses in batches of this many inserts
+CACHE_COMMIT_EVERY = 100
 
 # Patterns to extract street names (case insensitive)
 STREET_PATTERNS = [
@@ -47,12 +76,35 @@ LOCATION_PATTERNS = [
     r"angle\s+des\s+rues\s+([\w\-\'\u00C0-\u017F]+)\s+et\s+([\w\-\'\u00C0-\u017F]+)",
     # "intersection de X et Y"
     r"intersection\s+(?:de\s+)?(?:la\s+)?(rue|avenue|boulevard)\s+([\w\-\'\u00C0-\u017F]+)\s+et\s+(?:la\s+|l')?(rue|avenue|boulevard)?\s*([\w\-\'\u00C0-\u017F]+)",
-    # Address: "1086, rue Osborne"
-    r"\d+[,\s]+(?:de la\s+|de l')?(rue|avenue|boulevard)\s+([\w\-\'\u00C0-\u017F]+)",
+    # Address: "1086, rue Osborne" (only start at the first digit of a number)
+    r"(?<!\d)\d+[,\s]+(?:de la\s+|de l')?(rue|avenue|boulevard)\s+([\w\-\'\u00C0-\u017F]+)",
     # "situé à l'intersection de"
     r"situé\s+à\s+l'intersection\s+(?:de\s+)?(?:la\s+)?(rue|avenue|boulevard)?\s*([\w\-\'\u00C0-\u017F]+)",
 ]
 
+# Compiled once; extract_street_from_text tries these on every record
+LOCATION_RES = [re.compile(p, re.IGNORECASE) for p in LOCATION_PATTERNS]
+STREET_RES = [re.compile(p, re.IGNORECASE) for p in STREET_PATTERNS]
+
+# Every location/street pattern and fallback needs one of these keywords
+# (compared casefolded), so text without any of them can skip the regexes
+STREET_TRIGGERS = (
+    'rue', 'avenue', 'boulevard', 'chemin', 'place', 'square', 'côte', 'allée',
+    'parc', 'marché', 'quai', 'gare', 'église', 'université',
+    'coin', 'angle', 'intersection',
+)
+CODE_FILENAME_RE = re.compile(r'^[A-Z]{2,}\d+[\-_,]')
+# The (?<!...) guards make a failed match start only once per run of
+# whitespace, digits or punctuation instead of once per character, which
+# was quadratic on long runs. The leftmost match, and so the result, is
+# unchanged.
+COIN_RE = re.compile(r'(?<!\s)\s+coin\s+', re.IGNORECASE)
+ANGLE_RE = re.compile(r'(?<!\s)\s+angle\s+(des\s+rues\s+)?', re.IGNORECASE)
+TRAILING_WORDS_RE = re.compile(r'(?<!\s)\s+(devenu|devenue|aujourd\'hui|situé|vers|et\s+au|\.|\,).*$', re.IGNORECASE)
+ADDRESS_RE = re.compile(r'^[\d]+\s+(Rue|Avenue|Boulevard)', re.IGNORECASE)
+PARENTHETICAL_RE = re.compile(r'\([^)]+\)')
+TRAILING_SEPARATOR_RE = re.compile(r'\s*[-/].*$')
+
 def extract_street_from_text(text: str) -> str | None:
     """Extract a street name from any text field."""
     if not text:
@@ -61,12 +113,16 @@ def extract_street_from_text(text: str) -> str | None:
     text = text.strip()
 
     # Skip pure filenames/codes
-    if re.match(r'^[A-Z]{2,}\d+[\-_,]', text) or (text.endswith('.jpg') and 'rue' not in text.lower()):
+    if CODE_FILENAME_RE.match(text) or (text.endswith('.jpg') and 'rue' not in text.lower()):
+        return None
+
+    folded = text.casefold()
+    if not any(trigger in folded for trigger in STREET_TRIGGERS):
         return None
 
     # Try location patterns first (more specific)
-    for pattern in LOCATION_PATTERNS:
-        match = re.search(pattern, text, re.IGNORECASE)
+    for pattern in LOCATION_RES:
+        match = pattern.search(text)
         if match:
             groups = [g for g in match.groups() if g and g.lower() not in ['rue', 'avenue', 'boulevard']]
             if groups:
@@ -77,27 +133,27 @@ def extract_street_from_text(text: str) -> str | None:
                     return f"rue {groups[0]}, Montreal"
 
     # Try to extract street patterns
-    for pattern in STREET_PATTERNS:
-        match = re.search(pattern, text, re.IGNORECASE)
+    for pattern in STREET_RES:
+        match = pattern.search(text)
         if match:
             query = match.group(0).strip()
             # Clean up "coin" intersections for better geocoding
-            query = re.sub(r'\s+coin\s+', ' et ', query, flags=re.IGNORECASE)
-            query = re.sub(r'\s+angle\s+(des\s+rues\s+)?', ' et ', query, flags=re.IGNORECASE)
+            query = COIN_RE.sub(' et ', query)
+            query = ANGLE_RE.sub(' et ', query)
             # Remove trailing words that aren't part of the street name
-            query = re.sub(r'\s+(devenu|devenue|aujourd\'hui|situé|vers|et\s+au|\.|\,).*$', '', query, flags=re.IGNORECASE)
+            query = TRAILING_WORDS_RE.sub('', query)
             if len(query) > 5:  # Minimum reasonable length
                 return query
 
     # If text looks like a street address, use it directly
-    if re.match(r'^[\d]+\s+(Rue|Avenue|Boulevard)', text, re.IGNORECASE):
+    if ADDRESS_RE.match(text):
         return text
 
     # Try the whole text if it's short and contains street keywords
     if len(text) < 80 and any(kw in text.lower() for kw in ['rue', 'avenue', 'boulevard', 'parc', 'place', 'square']):
         # Remove parenthetical notes and trailing info
-        clean = re.sub(r'\([^)]+\)', '', text).strip()
-        clean = re.sub(r'\s*[-/].*$', '', clean).strip()
+        clean = PARENTHETICAL_RE.sub('', text).strip()
+        clean = TRAILING_SEPARATOR_RE.sub('', clean).strip()
         if clean and len(clean) > 5:
             return clean
 
@@ -118,23 +174,33 @@ DESCRIPTION_PATTERNS = [
     r"((?:rue|avenue|boulevard)\s+[\w\-\']+)\s*(?:/|et)\s*((?:rue|avenue|boulevard)\s+[\w\-\']+)",
 ]
 
+DESCRIPTION_RES = [re.compile(p, re.IGNORECASE) for p in DESCRIPTION_PATTERNS]
+# Every description pattern needs one of these keywords (compared casefolded)
+DESCRIPTION_TRIGGERS = ('rue', 'avenue', 'boulevard')
+WHITESPACE_RE = re.compile(r'\s+')
+TRAILING_PUNCT_RE = re.compile(r'(?<![.,;:!?])[.,;:!?]+$')
+
 
 def extract_from_description(description: str) -> str | None:
     """Extract street names from French archival descriptions."""
     if not description:
         return None
 
-    for pattern in DESCRIPTION_PATTERNS:
-        match = re.search(pattern, description, re.IGNORECASE)
+    folded = description.casefold()
+    if not any(trigger in folded for trigger in DESCRIPTION_TRIGGERS):
+        return None
+
+    for pattern in DESCRIPTION_RES:
+        match = pattern.search(description)
         if match:
             # Get all captured groups and join them
             groups = [g for g in match.groups() if g]
             if groups:
                 query = ' et '.join(groups)
                 # Clean up
-                query = re.sub(r'\s+', ' ', query).strip()
+                query = WHITESPACE_RE.sub(' ', query).strip()
                 # Remove trailing punctuation
-                query = re.sub(r'[.,;:!?]+$', '', query)
+                query = TRAILING_PUNCT_RE.sub('', query)
                 return query
 
     return None
@@ -171,40 +237,159 @@ def extract_street_query(record: dict) -> tuple[str | None, str]:
 
     return None, 'none'
 
-def geocode_mapbox(query: str, token: str) -> dict | None:
-    """Call Mapbox Geocoding API and return lat/lng."""
+
+class RateLimiter:
+    """
+    Token bucket shared across threads: refills at `rate` tokens per second up
+    to `capacity`, and each request takes one. Only real HTTP calls take a
+    token, so idle time is banked as burst capacity instead of lost.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self) -> None:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Going negative reserves a future token, queueing waiting threads in order
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if delay > 0:
+            time.sleep(delay)
+
+
+class GeocodeCache:
+    """SQLite cache of geocoding results keyed by normalized query."""
+
+    def __init__(self, path: Path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS geo(q TEXT PRIMARY KEY, response TEXT, ts INTEGER)')
+        self.pending = 0
+
+    @staticmethod
+    def key(query: str) -> str:
+        return query.strip().lower()
+
+    def get(self, query: str) -> dict | None:
+        """Return the cached result ({} for a cached no-match), or None on a miss."""
+        row = self.conn.execute('SELECT response FROM geo WHERE q = ?', (self.key(query),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, query: str, result: dict) -> None:
+        self.conn.execute(
+            'INSERT OR REPLACE INTO geo(q, response, ts) VALUES (?, ?, ?)',
+            (self.key(query), json.dumps(result, ensure_ascii=False), int(time.time())),
+        )
+        self.pending += 1
+        if self.pending >= CACHE_COMMIT_EVERY:
+            self.conn.commit()
+            self.pending = 0
+
+    def close(self) -> None:
+        self.conn.commit()
+        self.conn.close()
+
+
+def geocode_in_order(pool: ThreadPoolExecutor, queries: list, token: str, limiter: RateLimiter):
+    """Geocode queries on the pool, yielding results in input order.
+
+    At most REQUEST_WINDOW requests are queued ahead of the consumer, so an
+    interrupted run has little outstanding work to cancel.
+    """
+    pending = deque()
+    for query in queries:
+        pending.append(pool.submit(geocode_mapbox, query, token, limiter))
+        if len(pending) >= REQUEST_WINDOW:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+# One keep-alive connection per worker thread, so TLS setup is paid once per
+# thread instead of once per request
+_connections = threading.local()
+
+
+def mapbox_connection() -> http.client.HTTPSConnection:
+    conn = getattr(_connections, 'conn', None)
+    if conn is None:
+        conn = http.client.HTTPSConnection(MAPBOX_HOST, timeout=10)
+        _connections.conn = conn
+    return conn
+
+
+def reset_mapbox_connection() -> None:
+    conn = getattr(_connections, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _connections.conn = None
+
+
+def geocode_mapbox(query: str, token: str, limiter: RateLimiter | None = None) -> dict | None:
+    """
+    Call Mapbox Geocoding API and return lat/lng.
+
+    Returns {} when the API answered with no match, and None when the request
+    failed, so callers can cache the former but retry the latter.
+    """
     # Always add Montreal for better results
     if 'montreal' not in query.lower() and 'montréal' not in query.lower():
         query = f"{query}, Montreal, Quebec"
     encoded_query = quote(query)
-    url = (
-        f"https://api.mapbox.com/geocoding/v5/mapbox.places/{encoded_query}.json"
+    path = (
+        f"/geocoding/v5/mapbox.places/{encoded_query}.json"
         f"?access_token={token}"
         f"&bbox={MONTREAL_BBOX}"
         f"&limit=1"
         f"&types=address,poi,neighborhood,locality"
     )
 
-    try:
-        req = Request(url, headers={'User-Agent': 'mtl-archives-geocoder/1.0'})
-        with urlopen(req, timeout=10) as resp:
-            data = json.loads(resp.read().decode('utf-8'))
-
-        if data.get('features') and len(data['features']) > 0:
-            feature = data['features'][0]
-            lng, lat = feature['geometry']['coordinates']
-            return {
-                'latitude': lat,
-                'longitude': lng,
-                'geocode_place_name': feature.get('place_name', ''),
-                'geocode_confidence': feature.get('relevance', 0),
-            }
-    except HTTPError as e:
-        print(f"  HTTP error {e.code}: {e.reason}", file=sys.stderr)
-    except URLError as e:
-        print(f"  URL error: {e.reason}", file=sys.stderr)
-    except Exception as e:
-        print(f"  Error: {e}", file=sys.stderr)
+    for attempt in range(MAX_RETRIES + 1):
+        if limiter is not None:
+            limiter.wait()
+        try:
+            conn = mapbox_connection()
+            conn.request('GET', path, headers={'User-Agent': USER_AGENT})
+            resp = conn.getresponse()
+            body = resp.read()
+
+            if resp.status != 200:
+                if (resp.status == 429 or resp.status >= 500) and attempt < MAX_RETRIES:
+                    retry_after = resp.getheader('Retry-After')
+                    delay = float(retry_after) if retry_after and retry_after.isdigit() else RETRY_BACKOFF * 2 ** attempt
+                    print(f"  HTTP error {resp.status}, retrying in {delay:.1f}s", file=sys.stderr)
+                    time.sleep(delay)
+                    continue
+                print(f"  HTTP error {resp.status}: {resp.reason}", file=sys.stderr)
+                return None
+
+            data = load_json(body)
+            if data.get('features') and len(data['features']) > 0:
+                feature = data['features'][0]
+                lng, lat = feature['geometry']['coordinates']
+                return {
+                    'latitude': lat,
+                    'longitude': lng,
+                    'geocode_place_name': feature.get('place_name', ''),
+                    'geocode_confidence': feature.get('relevance', 0),
+                }
+            return {}
+        except (http.client.HTTPException, OSError) as e:
+            # Drop the connection; a keep-alive socket the server already
+            # closed fails on reuse and is worth one more attempt
+            reset_mapbox_connection()
+            if attempt < MAX_RETRIES:
+                continue
+            print(f"  Connection error: {e}", file=sys.stderr)
+        except Exception as e:
+            print(f"  Error: {e}", file=sys.stderr)
+        return None
 
     return None
 
@@ -214,6 +399,7 @@ def main():
     parser.add_argument('--dry-run', action='store_true', help='Parse streets without calling API')
     parser.add_argument('--limit', type=int, default=0, help='Limit number of records to process')
     parser.add_argument('--offset', type=int, default=0, help='Skip first N records')
+    parser.add_argument('--resume', action='store_true', help='Continue an interrupted run by appending to the existing output')
     args = parser.parse_args()
 
     # Load token
@@ -231,22 +417,31 @@ def main():
         print(f"Error: Input file not found: {input_path}", file=sys.stderr)
         sys.exit(1)
 
-    # Read manifest
+    # Output lines map 1:1 to input records, so resume right after the last complete line
+    start = args.offset
+    limit = args.limit
+    if args.resume and not args.dry_run and output_path.exists():
+        resumed = resume_point(output_path)
+        print(f"Resuming after {resumed} records already in {output_path}")
+        start += resumed
+        if args.limit > 0:
+            limit = args.limit - resumed
+            if limit <= 0:
+                print("No records to process.")
+                return
+
+    # Read manifest, applying offset and limit while streaming so records
+    # outside the window are never parsed or held
     print(f"Reading: {input_path}")
-    records = []
-    with open(input_path, 'r', encoding='utf-8') as f:
-        for line in f:
-            if line.strip():
-                records.append(json.loads(line))
+    stop = start + limit if limit > 0 else None
+    with open(input_path, 'rb') as f:
+        lines = islice((line for line in f if line.strip()), start, stop)
+        records = [load_json(line) for line in lines]
 
     print(f"Loaded {len(records)} records")
-
-    # Apply offset and limit
     if args.offset > 0:
-        records = records[args.offset:]
         print(f"Skipped first {args.offset} records")
     if args.limit > 0:
-        records = records[:args.limit]
         print(f"Processing {len(records)} records (limit applied)")
 
     # Stats
@@ -256,61 +451,89 @@ def main():
         'geocoded': 0,
         'failed': 0,
         'skipped': 0,
+        'cached': 0,
         'sources': {'name': 0, 'portal_description': 0, 'raw_description': 0, 'portal_record': 0},
     }
 
-    # Process records
-    geocoded_records = []
-
-    for i, record in enumerate(records):
-        name = record.get('name', '')
-        query, source = extract_street_query(record)
-
+    # Extract queries up front; only records with a query hit the API
+    extracted = [extract_street_query(record) for record in records]
+    for query, source in extracted:
         if not query:
             stats['skipped'] += 1
-            geocoded_records.append(record)
             continue
-
         stats['parseable'] += 1
         stats['sources'][source] = stats['sources'].get(source, 0) + 1
 
-        if args.dry_run:
-            print(f"[{i+1}/{len(records)}] {name[:50]}")
-            print(f"  -> Query: {query} (from {source})")
-            geocoded_records.append(record)
-            continue
-
-        # Rate limit
-        time.sleep(REQUEST_DELAY)
-
-        # Geocode
-        result = geocode_mapbox(query, token)
-
-        if result:
-            stats['geocoded'] += 1
-            record.update(result)
-            record['geocode_query'] = query
-            record['geocode_source'] = source
-            print(f"[{i+1}/{len(records)}] {name[:50]}")
-            print(f"  -> {result['latitude']:.5f}, {result['longitude']:.5f} ({result['geocode_confidence']:.2f})")
-        else:
-            stats['failed'] += 1
-            record['geocode_failed'] = True
-            record['geocode_query'] = query
-            print(f"[{i+1}/{len(records)}] {name[:50]} -> FAILED")
-
-        geocoded_records.append(record)
-
-        # Progress every 100
-        if (i + 1) % 100 == 0:
-            print(f"\n--- Progress: {i+1}/{len(records)} ({stats['geocoded']} geocoded, {stats['failed']} failed) ---\n")
-
-    # Write output
-    if not args.dry_run:
-        print(f"\nWriting: {output_path}")
-        with open(output_path, 'w', encoding='utf-8') as f:
-            for record in geocoded_records:
-                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+    if args.dry_run:
+        for i, (record, (query, source)) in enumerate(zip(records, extracted)):
+            if query:
+                print(f"[{i+1}/{len(records)}] {record.get('name', '')[:50]}")
+                print(f"  -> Query: {query} (from {source})")
+    else:
+        # Resolve what we can from the cache; each distinct uncached query is
+        # fetched once, in first-seen order
+        cache = GeocodeCache(project_root / 'data' / 'geocode_cache.sqlite')
+        resolved: dict[str, dict | None] = {}
+        misses = []
+        for query, _ in extracted:
+            if not query:
+                continue
+            key = cache.key(query)
+            if key in resolved:
+                continue
+            resolved[key] = cache.get(query)
+            if resolved[key] is None:
+                misses.append(query)
+        print(f"Cache: {len(resolved) - len(misses)} of {len(resolved)} distinct queries already geocoded")
+
+        # Geocode concurrently; results come back in input order, so the
+        # output is written in order and flushed as it goes
+        limiter = RateLimiter(REQUESTS_PER_SECOND, REQUEST_BURST)
+        print(f"\n{'Appending to' if args.resume else 'Writing'}: {output_path}")
+        pool = ThreadPoolExecutor(max_workers=REQUEST_CONCURRENCY)
+        try:
+            with open(output_path, 'ab' if args.resume else 'wb') as f:
+                results = geocode_in_order(pool, misses, token, limiter)
+                fetched = set()
+                done = 0
+                for i, (record, (query, source)) in enumerate(zip(records, extracted)):
+                    if query:
+                        name = record.get('name', '')
+                        key = cache.key(query)
+                        if resolved[key] is None and key not in fetched:
+                            fetched.add(key)
+                            resolved[key] = next(results)
+                            if resolved[key] is not None:
+                                cache.put(query, resolved[key])
+                        elif key not in fetched:
+                            stats['cached'] += 1
+                        result = resolved[key]
+                        if result:
+                            stats['geocoded'] += 1
+                            record.update(result)
+                            record['geocode_query'] = query
+                            record['geocode_source'] = source
+                            print(f"[{i+1}/{len(records)}] {name[:50]}")
+                            print(f"  -> {result['latitude']:.5f}, {result['longitude']:.5f} ({result['geocode_confidence']:.2f})")
+                        else:
+                            stats['failed'] += 1
+                            record['geocode_failed'] = True
+                            record['geocode_query'] = query
+                            print(f"[{i+1}/{len(records)}] {name[:50]} -> FAILED")
+
+                        done += 1
+                        if done % FLUSH_EVERY == 0:
+                            f.flush()
+
+                    f.write(dump_line(record))
+
+                    # Progress every 100
+                    if (i + 1) % 100 == 0:
+                        print(f"\n--- Progress: {i+1}/{len(records)} ({stats['geocoded']} geocoded, {stats['failed']} failed) ---\n")
+        finally:
+            # Don't wait on queued requests after a failure or Ctrl-C
+            pool.shutdown(wait=False, cancel_futures=True)
+            cache.close()
 
     # Print stats
     print("\n" + "="*50)
@@ -321,6 +544,7 @@ def main():
     print(f"Geocoded:          {stats['geocoded']} ({100*stats['geocoded']/max(1,stats['parseable']):.1f}% of parseable)")
     print(f"Failed:            {stats['failed']}")
     print(f"Skipped (no street): {stats['skipped']}")
+    print(f"From cache:        {stats['cached']}")
     print(f"\nSources breakdown:")
     for source, count in stats['sources'].items():
         if count > 0:
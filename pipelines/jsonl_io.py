@@ -0,0 +1,47 @@
+"""
+JSONL reading and writing shared by the pipeline scripts.
+
+orjson is used when it's installed. The stdlib fallback writes the same
+compact UTF-8 lines, so output bytes don't depend on which parser ran.
+"""
+
+import json
+from pathlib import Path
+
+try:
+    import orjson
+except ImportError:  # Fall back to the stdlib parser when orjson isn't installed
+    orjson = None
+
+# Reused for every record so each dump emits a complete JSONL line
+ORJSON_LINE_OPTIONS = orjson.OPT_APPEND_NEWLINE if orjson is not None else 0
+
+
+def load_json(data: str | bytes):
+    """Parse a JSON document or JSONL line, using orjson when available."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dump_line(record: dict) -> bytes:
+    """Serialize a record to a newline-terminated UTF-8 JSONL line."""
+    if orjson is not None:
+        return orjson.dumps(record, option=ORJSON_LINE_OPTIONS)
+    return (json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+def resume_point(path: Path) -> int:
+    """Count records already written to an output file, dropping a partial last line."""
+    lines = 0
+    end = 0
+    with open(path, 'rb+') as f:
+        position = 0
+        while chunk := f.read(1 << 20):
+            newlines = chunk.count(b'\n')
+            if newlines:
+                lines += newlines
+                end = position + chunk.rindex(b'\n') + 1
+            position += len(chunk)
+        f.truncate(end)
+    return lines
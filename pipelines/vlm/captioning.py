@@ -0,0 +1,626 @@
+"""
+Shared captioning loop for the VLM entry points.
+
+caption_images.py and caption_images_r2.py differ only in where a record's
+image is fetched from; model loading, prefetching, batching, resume and the
+output writer all live here.
+"""
+
+import argparse
+import copy
+import importlib.util
+import logging
+import queue
+import re
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import partial
+from io import BytesIO
+from itertools import islice
+from pathlib import Path
+from typing import Optional
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from PIL import Image
+from tqdm import tqdm
+from tqdm.contrib.logging import logging_redirect_tqdm
+import torch
+import transformers
+from transformers import AutoProcessor, BitsAndBytesConfig, LlavaForConditionalGeneration
+
+# Shared JSONL helpers live one level up, in pipelines/
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from jsonl_io import dump_line, load_json, resume_point
+
+# Configuration
+DEFAULT_MODEL = "llava-hf/llava-1.5-7b-hf"  # Good balance of speed/quality
+BATCH_SIZE = 8  # Images per generate() call
+VLLM_BATCH_SIZE = 32  # Requests handed to vLLM at once; its scheduler batches them internally
+MAX_NEW_TOKENS = 200
+PROMPT_BUCKET = 64  # With --compile, pad prompts to a multiple of this so few shapes get compiled
+COMPILE_MIN_TRANSFORMERS = (4, 47)  # First release whose LLaVA generate() handles the static KV cache
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+PREFETCH_WORKERS = 32  # Concurrent image downloads
+PREFETCH_WINDOW = 64  # Images fetched ahead of the GPU
+WRITE_QUEUE_SIZE = 256  # Finished entries buffered for the writer thread
+FETCH_RETRIES = 3  # Retries for transient 5xx responses and connection errors
+MAX_IMAGE_SIDE = 1024  # Longest side handed to the processor (the vision tower sees 336x336)
+MIN_IMAGE_SIDE = 336  # Processor's shortest_edge; downscaling never takes the short side below it
+MAX_DECODE_PIXELS = 50_000_000  # Refuse to decode anything larger, after JPEG draft scaling
+
+# Checked against MAX_DECODE_PIXELS once JPEG draft scaling has shrunk the image
+Image.MAX_IMAGE_PIXELS = None
+
+logger = logging.getLogger("vlm_caption")
+
+# Shared session so prefetch workers reuse pooled keep-alive connections
+SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=PREFETCH_WORKERS,
+    pool_maxsize=PREFETCH_WORKERS,
+    max_retries=Retry(total=FETCH_RETRIES, backoff_factor=0.3, status_forcelist=[500, 502, 503, 504]),
+)
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+
+# Each preprocessing thread gets its own processor copy; a fast tokenizer
+# isn't safe to call concurrently, and a lock would serialize image resizing too
+_thread_state = threading.local()
+_processor_copy_lock = threading.Lock()
+
+PROMPT_PLACEHOLDER = "{PROMPT}"  # Substituted into the chat template rendered once per run
+
+FILENAME_SUFFIXES = ('.jpg', '.jpeg', '.png', '.tif', '.tiff')
+COTE_RE = re.compile(r'^VM\d+[,\-_]', re.IGNORECASE)  # e.g. VM97,S3,D08,P298
+
+
+def is_real_name(name: str) -> bool:
+    """Check if a name is descriptive vs a cote code or filename."""
+    if not name or len(name) < 5:
+        return False
+    # Looks like a filename
+    if name.lower().endswith(FILENAME_SUFFIXES):
+        return False
+    # Looks like a cote code (e.g., VM97,S3,D08,P298)
+    if name.upper().startswith('VM') and any(c in name for c in ',_-'):
+        if COTE_RE.match(name):
+            return False
+    # Just numbers and punctuation
+    alpha_content = ''.join(c for c in name if c.isalpha() and c not in 'VM')
+    return len(alpha_content) >= 3
+
+
+def build_prompt(record: dict) -> str:
+    """Build a contextual prompt for the VLM."""
+    parts = []
+
+    name = record.get('name', '').strip()
+    date = None
+
+    # Try to get date from various sources
+    attrs = record.get('attributes_map', {})
+    if attrs.get('Date'):
+        date = attrs['Date']
+    elif record.get('portal_record', {}).get('Date'):
+        date = record['portal_record']['Date']
+
+    has_real_name = name and is_real_name(name)
+
+    if has_real_name or date:
+        parts.append("This is an archival photograph from Montreal's city archives.")
+        if has_real_name:
+            parts.append(f'It is titled "{name}".')
+        if date:
+            parts.append(f"It is dated {date}.")
+    else:
+        parts.append("This is a historical photograph from Montreal's city archives.")
+
+    parts.append("\nDescribe what you see in this image in 2-3 sentences. Focus on:")
+    parts.append("- The main subject (building, street, park, people, event)")
+    parts.append("- Notable visual details (architecture style, vehicles, clothing)")
+    parts.append("- The setting (urban, rural, indoor, outdoor)")
+    parts.append("\nBe specific and descriptive.")
+
+    return " ".join(parts)
+
+
+def fetch_image(url: str, timeout: int = 30) -> Optional[Image.Image]:
+    """Fetch and open an image from URL."""
+    try:
+        response = SESSION.get(url, timeout=timeout)
+        response.raise_for_status()
+        image = Image.open(BytesIO(response.content))
+        # Let JPEGs decode at a reduced scale that still covers MAX_IMAGE_SIDE
+        image.draft('RGB', (MAX_IMAGE_SIDE, MAX_IMAGE_SIDE))
+        if image.width * image.height > MAX_DECODE_PIXELS:
+            logger.warning("Skipping %s: %dx%d exceeds %d pixels", url, image.width, image.height, MAX_DECODE_PIXELS)
+            return None
+        image = image.convert('RGB')
+        image = downscale(image)
+        return image
+    except Exception as e:
+        logger.warning("Failed to fetch %s: %s", url, e)
+        return None
+
+
+def downscale(image: Image.Image) -> Image.Image:
+    """Shrink the long side to MAX_IMAGE_SIDE, keeping the short side >= MIN_IMAGE_SIDE."""
+    width, height = image.size
+    scale = max(MAX_IMAGE_SIDE / max(width, height), MIN_IMAGE_SIDE / min(width, height))
+    if scale >= 1:
+        return image
+    return image.resize((round(width * scale), round(height * scale)), Image.Resampling.BILINEAR)
+
+
+def utc_timestamp() -> str:
+    """Current UTC time in the same ISO 8601 form as JavaScript's toISOString()."""
+    return datetime.now(timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
+
+def iter_lines(path: Path, offset: int = 0, limit: int = 0):
+    """Stream raw manifest lines one at a time, applying offset and limit."""
+    stop = offset + limit if limit > 0 else None
+    with open(path, 'rb') as f:
+        for line in islice((line for line in f if line.strip()), offset, stop):
+            yield line if line.endswith(b'\n') else line + b'\n'
+
+
+def needs_captioning(record: dict) -> bool:
+    """Check if a record needs VLM captioning."""
+    source = record.get('description_source', '')
+    return source == 'synthetic' or 'synthetic' in source
+
+
+def record_to_caption(line: bytes, caption_all: bool = False) -> Optional[dict]:
+    """Parse a manifest line if its record needs captioning, otherwise return None."""
+    # Lines without "synthetic" anywhere can't need captioning, so skip parsing them
+    if not caption_all and b'synthetic' not in line:
+        return None
+    record = load_json(line)
+    if caption_all or needs_captioning(record):
+        return record
+    return None
+
+
+def transformers_version() -> tuple:
+    """Installed transformers (major, minor) version."""
+    return tuple(int(part) for part in transformers.__version__.split('.')[:2])
+
+
+def load_model(model_name: str, compile_model: bool = False, quant: str = "none"):
+    """Load the VLM model and processor."""
+    print(f"Loading model {model_name}...")
+    print(f"Device: {DEVICE}")
+
+    if DEVICE == "cuda":
+        print(f"GPU: {torch.cuda.get_device_name(0)}")
+        print(f"VRAM: {torch.cuda.get_device_properties(0).total_memory / 1e9:.1f} GB")
+
+        # TF32 tensor cores for any matmuls and convolutions left in float32
+        torch.set_float32_matmul_precision("high")
+        torch.backends.cudnn.allow_tf32 = True
+
+    torch_dtype = torch.float16 if DEVICE == "cuda" else torch.float32
+    quantization_config = None
+    # bitsandbytes weight quantization frees VRAM for larger batches
+    if quant == "nf4":
+        torch_dtype = torch.bfloat16
+        quantization_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.bfloat16,
+            bnb_4bit_use_double_quant=True,
+        )
+    elif quant == "int8":
+        quantization_config = BitsAndBytesConfig(load_in_8bit=True)
+
+    load_kwargs = {
+        "torch_dtype": torch_dtype,
+        "device_map": "auto" if DEVICE == "cuda" else None,
+        "low_cpu_mem_usage": True,
+        "quantization_config": quantization_config,
+    }
+    if DEVICE == "cuda":
+        # Fused attention kernels; FlashAttention 2 doesn't support the static cache used with --compile
+        if importlib.util.find_spec("flash_attn") is not None and not compile_model:
+            load_kwargs["attn_implementation"] = "flash_attention_2"
+        else:
+            load_kwargs["attn_implementation"] = "sdpa"
+
+    processor = AutoProcessor.from_pretrained(model_name)
+    try:
+        model = LlavaForConditionalGeneration.from_pretrained(model_name, **load_kwargs)
+    except (ImportError, ValueError) as e:
+        if load_kwargs.get("attn_implementation") != "flash_attention_2":
+            raise
+        print(f"FlashAttention 2 unavailable ({e}), falling back to SDPA")
+        load_kwargs["attn_implementation"] = "sdpa"
+        model = LlavaForConditionalGeneration.from_pretrained(model_name, **load_kwargs)
+
+    if DEVICE == "cuda":
+        model = model.eval()
+
+    if compile_model and DEVICE == "cuda":
+        # Cut per-token launch overhead during decode; first call pays the compile cost
+        import torch._inductor.config as inductor_config
+        inductor_config.coordinate_descent_tuning = True
+        inductor_config.fx_graph_cache = True
+        # Preallocated KV cache keeps decode shapes stable for CUDA graph capture
+        model.generation_config.cache_implementation = "static"
+        model.forward = torch.compile(model.forward, mode="reduce-overhead", fullgraph=False)
+
+    print(f"Model loaded (attention: {load_kwargs.get('attn_implementation', 'default')}).")
+    return model, processor
+
+
+def load_vllm(model_name: str):
+    """Load the model into a vLLM engine, plus the HF processor for its chat template."""
+    from vllm import LLM
+
+    print(f"Loading model {model_name} with vLLM...")
+    print(f"GPU: {torch.cuda.get_device_name(0)}")
+
+    processor = AutoProcessor.from_pretrained(model_name)
+    llm = LLM(model=model_name, dtype="float16", gpu_memory_utilization=0.9, max_num_seqs=VLLM_BATCH_SIZE)
+
+    print("Model loaded.")
+    return llm, processor
+
+
+def chat_template(processor) -> str:
+    """Render the model's chat template once around PROMPT_PLACEHOLDER."""
+    # LLaVA prompt format
+    conversation = [
+        {
+            "role": "user",
+            "content": [
+                {"type": "image"},
+                {"type": "text", "text": PROMPT_PLACEHOLDER},
+            ],
+        },
+    ]
+    return processor.apply_chat_template(conversation, add_generation_prompt=True)
+
+
+def thread_processor(processor):
+    """Return the calling thread's private copy of processor."""
+    if getattr(_thread_state, 'source', None) is not processor:
+        with _processor_copy_lock:
+            _thread_state.processor = copy.deepcopy(processor)
+        _thread_state.source = processor
+    return _thread_state.processor
+
+
+def preprocess(processor, image: Image.Image, text_prompt: str) -> dict:
+    """Turn an image and its templated prompt into single-sample model inputs."""
+    return thread_processor(processor)(text=text_prompt, images=image, return_tensors="pt")
+
+
+def fetch_and_preprocess(processor, url: str, text_prompt: str) -> Optional[dict]:
+    """Fetch an image and preprocess it off the main thread."""
+    image = fetch_image(url)
+    if image is None:
+        return None
+    return preprocess(processor, image, text_prompt)
+
+
+def fetch_vllm_request(url: str, text_prompt: str) -> Optional[dict]:
+    """Fetch an image and pair it with its templated prompt as a vLLM request."""
+    image = fetch_image(url)
+    if image is None:
+        return None
+    return {"prompt": text_prompt, "multi_modal_data": {"image": image}}
+
+
+def collate(samples: list, pad_token_id: int, pad_to_multiple: int = 0) -> dict:
+    """Left-pad single-sample inputs into one batch."""
+    # Left padding keeps every prompt flush against its generated tokens
+    length = max(inputs['input_ids'].shape[1] for inputs in samples)
+    if pad_to_multiple:
+        length = -(-length // pad_to_multiple) * pad_to_multiple
+    input_ids = torch.full((len(samples), length), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(samples), length), dtype=torch.long)
+
+    for i, inputs in enumerate(samples):
+        n = inputs['input_ids'].shape[1]
+        input_ids[i, length - n:] = inputs['input_ids'][0]
+        attention_mask[i, length - n:] = inputs['attention_mask'][0]
+
+    batch = {
+        'input_ids': input_ids,
+        'attention_mask': attention_mask,
+        'pixel_values': torch.cat([inputs['pixel_values'] for inputs in samples]),
+    }
+
+    if DEVICE == "cuda":
+        # Pinned host memory lets the copies to the GPU run asynchronously
+        batch = {name: tensor.pin_memory() for name, tensor in batch.items()}
+
+    return batch
+
+
+def caption_images_batch(model, processor, samples: list, pad_to_multiple: int = 0) -> list:
+    """Generate captions for a batch of preprocessed samples in a single generate call."""
+    pad_token_id = processor.tokenizer.pad_token_id
+    if pad_token_id is None:
+        pad_token_id = processor.tokenizer.eos_token_id
+
+    inputs = {
+        name: tensor.to(model.device, non_blocking=True)
+        for name, tensor in collate(samples, pad_token_id, pad_to_multiple).items()
+    }
+
+    with torch.inference_mode():
+        output = model.generate(
+            **inputs,
+            max_new_tokens=MAX_NEW_TOKENS,
+            do_sample=False,
+            pad_token_id=pad_token_id,
+        )
+
+    # Decode only the generated tokens, not the echoed prompt
+    generated = output[:, inputs['input_ids'].shape[1]:]
+    return [caption.strip() for caption in processor.batch_decode(generated, skip_special_tokens=True)]
+
+
+def caption_images_vllm(llm, vllm_requests: list) -> list:
+    """Generate captions for a batch of vLLM requests."""
+    from vllm import SamplingParams
+
+    outputs = llm.generate(vllm_requests, SamplingParams(max_tokens=MAX_NEW_TOKENS, temperature=0), use_tqdm=False)
+    return [output.outputs[0].text.strip() for output in outputs]
+
+
+def build_parser(description: str, input_help: str, output_help: str) -> argparse.ArgumentParser:
+    """Command-line options shared by the captioning entry points."""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--input", required=True, help=input_help)
+    parser.add_argument("--output", required=True, help=output_help)
+    parser.add_argument("--model", default=DEFAULT_MODEL, help=f"Model to use (default: {DEFAULT_MODEL})")
+    parser.add_argument("--limit", type=int, default=0, help="Limit number of records to process")
+    parser.add_argument("--offset", type=int, default=0, help="Skip first N records")
+    parser.add_argument("--resume", action="store_true", help="Continue an interrupted run by appending to --output")
+    parser.add_argument("--engine", choices=["hf", "vllm"], default="hf", help="Inference engine (default: hf)")
+    parser.add_argument("--batch-size", type=int, default=None, help=f"Images per generate call (default: {BATCH_SIZE}, or {VLLM_BATCH_SIZE} with --engine vllm)")
+    parser.add_argument("--quant", choices=["none", "int8", "nf4"], default="none", help="bitsandbytes weight quantization (CUDA only, default: none)")
+    parser.add_argument("--compile", action="store_true", help="torch.compile the model with a static KV cache (CUDA only)")
+    return parser
+
+
+def run(args, get_image_url, caption_all: bool = False, missing_url_error: str = 'no_image_url'):
+    """Caption the records selected by args, writing every record to args.output in manifest order."""
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s %(message)s", stream=sys.stderr)
+
+    if args.batch_size is None:
+        args.batch_size = VLLM_BATCH_SIZE if args.engine == "vllm" else BATCH_SIZE
+
+    input_path = Path(args.input)
+    output_path = Path(args.output)
+
+    if not input_path.exists():
+        print(f"Error: Input file not found: {input_path}", file=sys.stderr)
+        sys.exit(1)
+
+    if args.quant != "none" and DEVICE != "cuda":
+        print("Error: --quant requires a CUDA GPU", file=sys.stderr)
+        sys.exit(1)
+
+    if args.engine == "vllm":
+        if DEVICE != "cuda":
+            print("Error: --engine vllm requires a CUDA GPU", file=sys.stderr)
+            sys.exit(1)
+        if args.quant != "none" or args.compile:
+            print("Error: --quant and --compile only apply to --engine hf", file=sys.stderr)
+            sys.exit(1)
+
+    if args.compile and transformers_version() < COMPILE_MIN_TRANSFORMERS:
+        print(f"Error: --compile needs transformers>={'.'.join(map(str, COMPILE_MIN_TRANSFORMERS))} "
+              f"for LLaVA's static KV cache (found {transformers.__version__})", file=sys.stderr)
+        sys.exit(1)
+
+    # Load records
+    print(f"Reading from: {input_path}")
+
+    # Output lines map 1:1 to input records, so resume right after the last complete line
+    start = args.offset
+    limit = args.limit
+    if args.resume and output_path.exists():
+        resumed = resume_point(output_path)
+        print(f"Resuming after {resumed} records already in {output_path}")
+        start += resumed
+        if args.limit > 0:
+            limit = args.limit - resumed
+            if limit <= 0:
+                print("No records to process.")
+                return
+
+    # Count up front without holding the manifest in memory
+    total = 0
+    to_process = 0
+    for line in iter_lines(input_path, start, limit):
+        total += 1
+        if caption_all or record_to_caption(line) is not None:
+            to_process += 1
+
+    if args.offset > 0:
+        print(f"Skipped {args.offset} records (offset)")
+
+    if args.limit > 0:
+        print(f"Limited to {args.limit} records")
+
+    print(f"Total records: {total}")
+
+    if not caption_all:
+        print(f"Records needing captioning: {to_process}")
+
+    if not to_process:
+        print("No records to process.")
+        return
+
+    # Load model
+    pad_to_multiple = PROMPT_BUCKET if args.compile and DEVICE == "cuda" else 0
+    if args.engine == "vllm":
+        llm, processor = load_vllm(args.model)
+        prepare = fetch_vllm_request
+        generate_captions = partial(caption_images_vllm, llm)
+    else:
+        model, processor = load_model(args.model, compile_model=args.compile, quant=args.quant)
+        prepare = partial(fetch_and_preprocess, processor)
+        generate_captions = partial(caption_images_batch, model, processor, pad_to_multiple=pad_to_multiple)
+    template = chat_template(processor)
+
+    if args.compile and DEVICE == "cuda":
+        # Compile on a dummy batch so the first real batch isn't stalled
+        print("Warming up compiled model...")
+        warmup = preprocess(processor, Image.new('RGB', (336, 336)), template.replace(PROMPT_PLACEHOLDER, "warmup"))
+        generate_captions([warmup] * args.batch_size)
+
+    # Process records
+    print(f"\nProcessing {to_process} images...")
+
+    captioned = 0
+    errors = 0
+
+    with (
+        open(output_path, 'ab' if args.resume else 'wb') as out_f,
+        ThreadPoolExecutor(max_workers=PREFETCH_WORKERS) as pool,
+        logging_redirect_tqdm(),
+    ):
+        # Parsed records or raw lines in manifest order, paired with their pending download and preprocessing (None = ready to write)
+        pending = deque()
+        # The entries of pending that still hold a future, oldest first
+        in_flight = deque()
+        progress = tqdm(total=to_process, desc="Captioning", mininterval=1.0)
+        writer_queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+        writer_errors = []
+
+        def write_output():
+            # Serialize and write finished entries off the captioning thread
+            try:
+                while (item := writer_queue.get()) is not None:
+                    out_f.write(item if isinstance(item, bytes) else dump_line(item))
+                    if writer_queue.empty():
+                        out_f.flush()
+            except Exception as e:
+                writer_errors.append(e)
+                # Keep draining so the captioning thread never blocks on a full queue
+                while writer_queue.get() is not None:
+                    pass
+
+        writer = threading.Thread(target=write_output, daemon=True)
+        writer.start()
+
+        def caption_batch(batch):
+            nonlocal captioned, errors
+            try:
+                captions = generate_captions([sample for _, sample in batch])
+            except Exception as e:
+                if len(batch) > 1:
+                    # Retry one by one so a single bad image doesn't fail its neighbours
+                    for item in batch:
+                        caption_batch([item])
+                    return
+                record = batch[0][0]
+                record['vlm_caption'] = None
+                record['vlm_error'] = str(e)
+                errors += 1
+                return
+
+            captioned_at = utc_timestamp()
+            for (record, _), caption in zip(batch, captions):
+                record['vlm_caption'] = caption
+                record['vlm_captioned_at'] = captioned_at
+                captioned += 1
+
+        def caption_next_batch():
+            nonlocal errors
+            # Caption the oldest downloads together
+            batch = []
+            resolved = 0
+            while in_flight and len(batch) < args.batch_size:
+                entry = in_flight.popleft()
+                record, future = entry
+                entry[1] = None
+                resolved += 1
+
+                try:
+                    sample = future.result()
+                except Exception as e:
+                    record['vlm_caption'] = None
+                    record['vlm_error'] = str(e)
+                    errors += 1
+                    continue
+
+                if sample is None:
+                    record['vlm_caption'] = None
+                    record['vlm_error'] = 'fetch_failed'
+                    errors += 1
+                else:
+                    batch.append((record, sample))
+
+            if batch:
+                caption_batch(batch)
+            progress.update(resolved)
+            write_finished()
+
+        def write_finished():
+            # Hand everything that is now finished to the writer, in manifest order
+            while pending and pending[0][1] is None:
+                writer_queue.put(pending.popleft()[0])
+
+            if writer_errors:
+                raise writer_errors[0]
+
+        try:
+            for line in iter_lines(input_path, start, limit):
+                record = record_to_caption(line, caption_all=caption_all)
+                if record is None:
+                    # Written back untouched, without a JSON round-trip
+                    pending.append([line, None])
+                    write_finished()
+                    continue
+
+                future = None
+                url = get_image_url(record)
+
+                if not url:
+                    record['vlm_caption'] = None
+                    record['vlm_error'] = missing_url_error
+                    errors += 1
+                    progress.update()
+                else:
+                    text_prompt = template.replace(PROMPT_PLACEHOLDER, build_prompt(record))
+                    future = pool.submit(prepare, url, text_prompt)
+
+                entry = [record, future]
+                pending.append(entry)
+                if future is None:
+                    write_finished()
+                else:
+                    in_flight.append(entry)
+
+                # Caption the oldest downloads once the window is full
+                while len(in_flight) > PREFETCH_WINDOW:
+                    caption_next_batch()
+
+            while in_flight:
+                caption_next_batch()
+            write_finished()
+        finally:
+            writer_queue.put(None)
+            writer.join()
+
+        if writer_errors:
+            raise writer_errors[0]
+
+        progress.close()
+
+    print(f"\n=== Complete ===")
+    print(f"Captioned: {captioned}")
+    print(f"Errors: {errors}")
+    print(f"Output: {output_path}")
+